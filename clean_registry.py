@@ -16,6 +16,7 @@ v1.6.1 by Ricardo Branco
 MIT License
 """
 
+import functools
 import os
 import re
 import shlex
@@ -24,25 +25,53 @@ import tarfile
 import subprocess
 
 from argparse import ArgumentParser
-from distutils.version import LooseVersion
-from glob import iglob
-from io import BytesIO
-from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj, rmtree
 from requests.exceptions import RequestException
 
 import docker
 from docker.errors import DockerException
 
-import yaml
-
 VERSION = "1.6.1"
 REGISTRY_DIR = "REGISTRY_STORAGE_FILESYSTEM_ROOTREGISTRY_DIR"
 args = None
 
+# Directory fd and path of <registry_dir>/docker/registry/v2/repositories.
+# All paths in the clean_* helpers are relative to this directory, so the
+# kernel resolves the long base path only once.
+root_fd = None
+root_path = None
+
+# From https://github.com/moby/moby/blob/master/image/spec/v1.2.md
+# Tag values are limited to the set of characters [a-zA-Z0-9_.-], except they may not start with a . or - character.
+# Tags are limited to 128 characters.
+#
+# From https://github.com/docker/distribution/blob/master/docs/spec/api.md
+# 1. A repository name is broken up into path components. A component of a repository name must be at least
+#    one lowercase, alpha-numeric characters, optionally separated by periods, dashes or underscores.
+#    More strictly, it must match the regular expression [a-z0-9]+(?:[._-][a-z0-9]+)*
+# 2. If a repository name has two or more path components, they must be separated by a forward slash ("/").
+# 3. The total length of a repository name, including slashes, must be less than 256 characters.
+#
+# Note: Internally, distribution permits multiple dashes and up to 2 underscores as separators.
+# See https://github.com/docker/distribution/blob/master/reference/regexp.go
+_REF_RE = re.compile(
+    r'(?=.{1,255}\Z)'
+    r'[a-z0-9]+(?:(?:[._]|__|[-]*)[a-z0-9]+)*'
+    r'(?:/[a-z0-9]+(?:(?:[._]|__|[-]*)[a-z0-9]+)*)*'
+    r'(?::[a-zA-Z0-9_][a-zA-Z0-9_.-]{0,127})?\Z'
+)
+
 
 os.environ['LC_ALL'] = 'C.UTF-8'
 
 
+def _parse_ver(version):
+    '''Parses a version string like "v2.4.0" into a comparable tuple'''
+    version = re.split(r"[-+]", version.lstrip("v"))[0]
+    return tuple(int(_) for _ in version.split(".")[:3])
+
+
 def dockerized():
     '''Returns True if we're inside a Docker container, False otherwise.'''
     return os.path.isfile("/.dockerenv")
@@ -57,68 +86,170 @@ def error(msg, bye=True):
 
 def remove(path):
     '''Run rmtree() in verbose mode'''
-    rmtree(path)
+    # rmtree() does not support dir_fd, so fall back to the absolute path
+    try:
+        rmtree(os.path.join(root_path, path) if root_path else path)
+    except FileNotFoundError:
+        return  # already removed
+    if not args.quiet:
+        print("removed directory " + path)
+
+
+def _scandir(path):
+    '''Yields the DirEntry's of a directory relative to the repositories root'''
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+    try:
+        with os.scandir(fd) as entries:
+            yield from entries
+    finally:
+        os.close(fd)
+
+
+def _fast_remove_sha_dir(path):
+    '''Remove a sha256 directory, normally containing only files (the "link" blob)'''
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=root_fd)
+    except FileNotFoundError:
+        return  # already removed
+    try:
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                os.unlink(entry.name, dir_fd=fd)
+    except IsADirectoryError:
+        # schema1 revisions carry a signatures/ subtree: let rmtree take it
+        remove(path)
+        return
+    finally:
+        os.close(fd)
+    os.rmdir(path, dir_fd=root_fd)
     if not args.quiet:
         print("removed directory " + path)
 
 
+def _read_link(path):
+    '''Reads the digest from a "link" file with a bare open/read/close'''
+    fd = os.open(path, os.O_RDONLY, dir_fd=root_fd)
+    try:
+        return os.read(fd, 128)[7:].decode('utf-8')  # strip "sha256:"
+    finally:
+        os.close(fd)
+
+
+def _only_tag(path, tag):
+    '''Returns True if tag is the only entry in the tags directory'''
+    found = None
+    for entry in _scandir(path):
+        if found is not None:
+            return False
+        found = entry.name
+    return found == tag
+
+
+def _iter_repositories(path=""):
+    '''Yields every repository below the repositories root, one scandir at a time'''
+    for entry in _scandir(path or "."):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        if entry.name == "_manifests":
+            yield path
+        elif not entry.name.startswith("_"):
+            yield from _iter_repositories(f"{path}/{entry.name}" if path else entry.name)
+
+
+def _iter_tag_index_sha_entries(repo):
+    '''Yields the sha256 index entries of every tag in a repository'''
+    tags_root = f"{repo}/_manifests/tags"
+    for tag_entry in _scandir(tags_root):
+        try:
+            yield from _scandir(f"{tags_root}/{tag_entry.name}/index/sha256")
+        except FileNotFoundError:
+            continue
+
+
 def clean_revisions(repo):
     '''Remove the revision manifests that are not present in the tags directory'''
-    revisions = set(
-        os.listdir(repo + "/_manifests/revisions/sha256/")
-    )
-    manifests = set(
-        map(os.path.basename, iglob(repo + "/_manifests/tags/*/*/sha256/*"))
-    )
-    revisions.difference_update(manifests)
-    for revision in revisions:
-        remove(repo + "/_manifests/revisions/sha256/" + revision)
+    rev_root = f"{repo}/_manifests/revisions/sha256"
+    revisions = {entry.name for entry in _scandir(rev_root)}
+    manifests = {entry.name for entry in _iter_tag_index_sha_entries(repo)}
+    for revision in revisions - manifests:
+        _fast_remove_sha_dir(f"{rev_root}/{revision}")
 
 
 def clean_tag(repo, tag):
     '''Clean a specific repo:tag'''
-    link = repo + "/_manifests/tags/" + tag + "/current/link"
-    if not os.path.isfile(link):
+    tag_dir = f"{repo}/_manifests/tags/{tag}"
+    try:
+        current = _read_link(f"{tag_dir}/current/link")
+    except FileNotFoundError:
         error("No such tag: %s in repository %s" % (tag, repo), bye=False)
         return False
     if args.remove:
-        remove(repo + "/_manifests/tags/" + tag)
+        remove(tag_dir)
     else:
-        with open(link) as infile:
-            current = infile.read()[len("sha256:"):]
-        path = repo + "/_manifests/tags/" + tag + "/index/sha256/"
-        for index in os.listdir(path):
-            if index == current:
+        index_dir = f"{tag_dir}/index/sha256"
+        for entry in _scandir(index_dir):
+            if entry.name == current:
                 continue
-            remove(path + index)
+            _fast_remove_sha_dir(f"{index_dir}/{entry.name}")
     clean_revisions(repo)
     return True
 
 
-def clean_repo(image):
+def clean_repo(image, existing):
     '''Clean all tags (or a specific one, if specified) from a specific repository'''
     repo, tag = image.split(":", 1) if ":" in image else (image, "")
 
-    if not os.path.isdir(repo):
+    # The caller already listed the top-level repositories, so only nested
+    # repository paths need a stat
+    if "/" in repo:
+        found = os.path.isdir(os.path.join(root_path, repo) if root_path else repo)
+    else:
+        found = repo in existing
+    if not found:
         error("No such repository: " + repo, bye=False)
         return False
 
+    tags_root = f"{repo}/_manifests/tags"
+
     if args.remove:
-        tags = set(os.listdir(repo + "/_manifests/tags/"))
-        if not tag or len(tags) == 1 and tag in tags:
+        # The repository may have been removed by an earlier image argument
+        # naming it (e.g. "foo foo:a")
+        try:
+            only = not tag or _only_tag(tags_root, tag)
+        except FileNotFoundError:
+            error("No such repository: " + repo, bye=False)
+            return False
+        if only:
             remove(repo)
             return True
 
     if tag:
         return clean_tag(repo, tag)
 
+    tag_dirs = [f"{tags_root}/{entry.name}" for entry in _scandir(tags_root)]
+
+    def read_current(tag_dir):
+        try:
+            return _read_link(f"{tag_dir}/current/link")
+        except FileNotFoundError:
+            return None
+
+    # Read the current/link files concurrently to overlap their per-file
+    # open/read/close latency, then prune the indexes against the whole set
     currents = set()
-    for link in iglob(repo + "/_manifests/tags/*/current/link"):
-        with open(link) as infile:
-            currents.add(infile.read()[len("sha256:"):])
-    for index in iglob(repo + "/_manifests/tags/*/index/sha256/*"):
-        if os.path.basename(index) not in currents:
-            remove(index)
+    if tag_dirs:
+        with ThreadPoolExecutor(max_workers=min(32, len(tag_dirs))) as executor:
+            currents = set(executor.map(read_current, tag_dirs))
+        currents.discard(None)
+
+    for tag_dir in tag_dirs:
+        index_dir = f"{tag_dir}/index/sha256"
+        try:
+            for entry in _scandir(index_dir):
+                if entry.name not in currents:
+                    _fast_remove_sha_dir(f"{index_dir}/{entry.name}")
+        except FileNotFoundError:
+            continue
 
     clean_revisions(repo)
     return True
@@ -126,26 +257,27 @@ def clean_repo(image):
 
 def check_name(image):
     '''Checks the whole repository:tag name'''
-    repo, tag = image.split(":", 1) if ":" in image else (image, "latest")
+    return _REF_RE.match(image) is not None
 
-    # From https://github.com/moby/moby/blob/master/image/spec/v1.2.md
-    # Tag values are limited to the set of characters [a-zA-Z0-9_.-], except they may not start with a . or - character.
-    # Tags are limited to 128 characters.
-    #
-    # From https://github.com/docker/distribution/blob/master/docs/spec/api.md
-    # 1. A repository name is broken up into path components. A component of a repository name must be at least
-    #    one lowercase, alpha-numeric characters, optionally separated by periods, dashes or underscores.
-    #    More strictly, it must match the regular expression [a-z0-9]+(?:[._-][a-z0-9]+)*
-    # 2. If a repository name has two or more path components, they must be separated by a forward slash ("/").
-    # 3. The total length of a repository name, including slashes, must be less than 256 characters.
 
-    # Note: Internally, distribution permits multiple dashes and up to 2 underscores as separators.
-    # See https://github.com/docker/distribution/blob/master/reference/regexp.go
+class _ChunkStream():
+    '''Minimal read-only file-like object over an iterable of byte chunks'''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
 
-    return len(image) < 256 and len(tag) < 129 and \
-        re.match('[a-zA-Z0-9_][a-zA-Z0-9_.-]*$', tag) and \
-        all(re.match('[a-z0-9]+(?:(?:[._]|__|[-]*)[a-z0-9]+)*$', path)
-            for path in repo.split("/"))
+    def read(self, size=-1):
+        if size < 0:
+            data = self._buf + b"".join(self._chunks)
+            self._buf = b""
+            return data
+        while len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
 
 
 class RegistryCleaner():
@@ -179,30 +311,47 @@ class RegistryCleaner():
         if not self.info['Config']['Image'].startswith("registry:2"):
             error("The container %s is not running the registry:2 image" % container)
 
-        if LooseVersion(self.get_image_version()) < LooseVersion("v2.4.0"):
+        if _parse_ver(self.image_version) < (2, 4, 0):
             error("You're not running Docker Registry 2.4.0+")
 
-        self.registry_dir = self.get_registry_dir()
-
         if dockerized():
             os.environ[REGISTRY_DIR] = self.registry_dir
 
     def __call__(self):
+        global root_fd, root_path
+        root_path = self.registry_dir + "/docker/registry/v2/repositories"
         try:
-            os.chdir(self.registry_dir + "/docker/registry/v2/repositories")
+            root_fd = os.open(root_path, os.O_RDONLY | os.O_DIRECTORY)
         except OSError as err:
             error(err)
 
         if self.container is not None:
             self.docker.api.stop(self.container)
 
-        images = args.images or \
-            map(os.path.dirname, iglob("**/_manifests", recursive=True))
+        with os.scandir(root_fd) as entries:
+            existing = {entry.name for entry in entries if entry.is_dir()}
+
+        def clean_images(images):
+            '''Sequentially clean images that share a repository'''
+            return all([clean_repo(image, existing) for image in images])
+
+        # Cleaning is dominated by directory traversal and unlink syscalls,
+        # so concurrent workers keep the filesystem's request queue busy.
+        # Images naming the same repository go into one task, since two
+        # clean_revisions runs on the same repository would race each other
+        if args.images:
+            grouped = {}
+            for image in args.images:
+                grouped.setdefault(image.split(":", 1)[0], []).append(image)
+            image_groups = grouped.values()
+            max_workers = min(32, len(grouped))
+        else:
+            image_groups = ([repo] for repo in _iter_repositories())
+            max_workers = 32
 
-        exit_status = 0
-        for image in images:
-            if not clean_repo(image):
-                exit_status = 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(clean_images, image_groups))
+        exit_status = 0 if all(results) else 1
 
         if not self.garbage_collect():
             exit_status = 1
@@ -219,17 +368,18 @@ class RegistryCleaner():
     def get_file(self, path):
         '''Returns the contents of the specified file from the container'''
         try:
-            with BytesIO(b"".join(
-                    _ for _ in self.docker.api.get_archive(self.container, path)[0]
-            )) as buf, tarfile.open(fileobj=buf) \
-                    as tar, tar.extractfile(os.path.basename(path)) \
-                    as infile:
-                data = infile.read()
+            stream, _ = self.docker.api.get_archive(self.container, path)
+            with tarfile.open(fileobj=_ChunkStream(stream), mode="r|") as tar:
+                for member in tar:
+                    if member.name == os.path.basename(path):
+                        with tar.extractfile(member) as infile:
+                            return infile.read()
         except (RequestException, DockerException) as err:
             error(err)
-        return data
+        return None
 
-    def get_registry_dir(self):
+    @functools.cached_property
+    def registry_dir(self):
         '''Gets the Registry directory'''
         registry_dir = os.getenv(REGISTRY_DIR)
         if registry_dir:
@@ -242,8 +392,15 @@ class RegistryCleaner():
                 break
 
         if not registry_dir:
+            # Only this fallback needs yaml, so keep it off the import path
+            # of every other invocation
+            import yaml
+            try:
+                from yaml import CSafeLoader as yaml_loader
+            except ImportError:
+                from yaml import SafeLoader as yaml_loader
             config_yml = self.info['Args'][0]
-            data = yaml.load(self.get_file(config_yml), Loader=yaml.FullLoader)
+            data = yaml.load(self.get_file(config_yml), Loader=yaml_loader)
             try:
                 registry_dir = data['storage']['filesystem']['rootdirectory']
             except KeyError:
@@ -261,7 +418,8 @@ class RegistryCleaner():
                 return item['Source']
         return None
 
-    def get_image_version(self):
+    @functools.cached_property
+    def image_version(self):
         '''Gets the Docker distribution version running on the container'''
         try:
             if self.info['State']['Running']:
@@ -287,9 +445,11 @@ class RegistryCleaner():
                     stderr=subprocess.STDOUT
             ) as proc:
                 # It seems we have to consume stdout so we have a return code
-                out = proc.stdout.read()
-                if not args.quiet:
-                    print(out.decode('utf-8'))
+                if args.quiet:
+                    proc.stdout.read()
+                else:
+                    copyfileobj(proc.stdout, sys.stdout.buffer)
+                    sys.stdout.flush()
             status = bool(proc.returncode == 0)
         else:
             cli = self.docker.containers.run(
@@ -305,8 +465,9 @@ class RegistryCleaner():
                 }
             )
             if not args.quiet:
-                for line in cli.logs(stream=True):
-                    print(line.decode('utf-8'), end="")
+                for chunk in cli.logs(stream=True, follow=True):
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
             status = bool(cli.wait()['StatusCode'] == 0)
             cli.remove()
         return status